@@ -1,17 +1,51 @@
-from flask import Flask
-import threading
-from bot import EnhancedArbitrageBot
 import asyncio
+import contextlib
+import logging
+import os
 
-app = Flask(__name__)
+from aiohttp import web
 
-@app.route('/')
-def home():
-    return "Arbitrage Bot is running!"
+from bot import FlashLoanArbBot, setup_logging, use_uvloop
 
-def start_bot():
-    bot = EnhancedArbitrageBot()
-    asyncio.run(bot.run())
+BOT = web.AppKey("bot", FlashLoanArbBot)
+BOT_TASK = web.AppKey("bot_task", asyncio.Task)
 
-# Start the bot in a background thread when the server starts
-threading.Thread(target=start_bot, daemon=True).start()
+logger = logging.getLogger(__name__)
+
+async def home(request):
+    bot, task = request.app[BOT], request.app[BOT_TASK]
+    if task.done():
+        error = None if task.cancelled() else task.exception()
+        return web.Response(status=503, text=f"Arbitrage Bot stopped: {error!r}")
+    return web.Response(text=f"Arbitrage Bot is running! Last check: {bot.last_check}, block: {bot.block_number}")
+
+def report_bot_exit(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Arbitrage bot stopped", exc_info=task.exception())
+
+# The bot runs as a task on the server's own event loop, so the route can read its state directly
+async def start_bot(app):
+    app[BOT] = FlashLoanArbBot()
+    app[BOT_TASK] = asyncio.create_task(app[BOT].run())
+    app[BOT_TASK].add_done_callback(report_bot_exit)
+
+async def stop_bot(app):
+    if app[BOT_TASK].done():
+        return  # Already reported by report_bot_exit
+    app[BOT_TASK].cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await app[BOT_TASK]
+
+def create_app():
+    app = web.Application()
+    app.router.add_get('/', home)
+    app.on_startup.append(start_bot)
+    app.on_cleanup.append(stop_bot)
+    return app
+
+app = create_app()
+
+if __name__ == "__main__":
+    setup_logging()
+    use_uvloop()
+    web.run_app(app, port=int(os.environ.get("PORT", 10000)))
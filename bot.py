@@ -1,32 +1,111 @@
+import asyncio
+import atexit
+import logging
+import math
 import os
+import queue
+import random
 import time
-from threading import Thread
-from flask import Flask
+from logging.handlers import QueueHandler, QueueListener
+import aiohttp
+import orjson
 from dotenv import load_dotenv
-from web3 import Web3
-from web3.middleware import geth_poa_middleware
+from web3 import AsyncHTTPProvider, AsyncWeb3, Web3
+from web3.exceptions import TransactionNotFound
+from web3.middleware import async_geth_poa_middleware
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # PancakeSwap v2 Router
 PANCAKE_ROUTER = "0x10ED43C718714eb63d5aA57B78B54704E256024E"
 USDT = Web3.to_checksum_address("0x55d398326f99059fF775485246999027B3197955")
 BUSD = Web3.to_checksum_address("0xe9e7cea3dedca5984780Bafc599bD69aDd087D56")
+WBNB = Web3.to_checksum_address("0xbb4CdB9CBd36B01bD1cBaEBF2De08d9173bc095c")
+BSC_CHAIN_ID = 56
+
+# Multicall3 (same address on every EVM chain) and the selectors used with it
+MULTICALL3 = Web3.to_checksum_address("0xcA11bde05977b3631167028862bE2a173976CA11")
+AGGREGATE3_SELECTOR = "0x82ad56cb"
+GET_ETH_BALANCE_SELECTOR = "0x4d2301cc"
+GET_BLOCK_NUMBER_SELECTOR = "0x42cbb15c"
+
+# PancakeSwap V2 factory()/getPair() and pair getReserves() selectors
+FACTORY_SELECTOR = "0xc45a0155"
+GET_PAIR_SELECTOR = "0xe6a43905"
+GET_RESERVES_SELECTOR = "0x0902f1ac"
+
+# Flash loan direction flag -> (token borrowed, token swapped into, label)
+DIRECTIONS = {
+    True: (USDT, BUSD, "USDT→BUSD→USDT"),
+    False: (BUSD, USDT, "BUSD→USDT→BUSD"),
+}
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+# Receipt polling backoff (s) when there is no head subscription; the last delay repeats
+RECEIPT_POLL_DELAYS = (2, 3, 5, 8)
+# Errors that mean an endpoint is slow or unreachable rather than the call being wrong
+RPC_FAILOVER_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+# One timeout config shared by the session and every web3 provider
+RPC_TIMEOUT = aiohttp.ClientTimeout(total=5, connect=2)
+
+# Status message templates, filled with str.format_map
+PROBE_MSG = "Loan: {loan:.2f}, Dir: {label}, Profit: {profit:.6f} USDT, Gas: {gas:.4f} USDT, Fee: {fee:.6f} USDT"
+FOUND_MSG = "Profitable opportunity found! Profit: {profit:.6f} USDT ({percent:.2f}%, loan: {loan:.2f})"
+EXECUTE_MSG = "Executing flash loan: {loan:.2f} USDT, Direction: {label}"
+
+# 4-byte selector of getAmountsOut(uint256,address[])
+GET_AMOUNTS_OUT_SELECTOR = "0xd06ca61f"
 
 ROUTER_ABI = [
     {"inputs":[{"internalType":"uint256","name":"amountIn","type":"uint256"},{"internalType":"address[]","name":"path","type":"address[]"}],"name":"getAmountsOut","outputs":[{"internalType":"uint256[]","name":"","type":"uint256[]"}],"stateMutability":"view","type":"function"},
 ]
 
-# Load your deployed flash loan contract ABI and address from environment or file
-FLASHLOAN_CONTRACT_ADDRESS = Web3.to_checksum_address(os.getenv("FLASHLOAN_CONTRACT_ADDRESS"))
-with open("FlashLoanArb.abi") as f:
-    FLASHLOAN_CONTRACT_ABI = f.read()
+def v2_amount_out(amount_in, reserve_in, reserve_out):
+    # PancakeSwap V2 getAmountOut (0.25% fee), in integers
+    amount_in_with_fee = amount_in * 9975
+    return amount_in_with_fee * reserve_out // (reserve_in * 10_000 + amount_in_with_fee)
+
+def v2_optimal_input(reserve_a_in, reserve_a_out, reserve_b_in, reserve_b_out, cost_bps):
+    # Input maximising out - input * (1 + cost_bps) through two V2 pools; the two legs fold into one
+    # virtual pool (e_in, e_out), whose optimum is (sqrt(fee * e_in * e_out / cost) - e_in) / fee
+    denominator = reserve_b_in * 10_000 + reserve_a_out * 9975
+    e_in = reserve_a_in * reserve_b_in * 10_000 // denominator
+    e_out = reserve_a_out * reserve_b_out * 9975 // denominator
+    root = math.isqrt(e_in * e_out * 9975 // (10_000 + cost_bps))
+    return max(0, (root - e_in) * 10_000 // 9975)
+
+class BatchRejectedError(aiohttp.ClientError):
+    # An endpoint answered a JSON-RPC batch with one error object; another endpoint may accept it
+    pass
+
+class OrjsonHTTPProvider(AsyncHTTPProvider):
+    # web3's default decoder goes through the stdlib json module; receipts and eth_call results are hot
+    def decode_rpc_response(self, raw_response):
+        return orjson.loads(raw_response)
 
 class FlashLoanArbBot:
     def __init__(self):
         self.BSC_RPC = os.getenv("BSC_RPC", "https://bsc-dataseed.binance.org/")
-        self.web3 = Web3(Web3.HTTPProvider(self.BSC_RPC))
-        self.web3.middleware_onion.inject(geth_poa_middleware, layer=0)
+        # Extra endpoints raced against BSC_RPC for read-only calls
+        self.BSC_RPCS = [self.BSC_RPC] + [
+            url for url in os.getenv(
+                "BSC_RPCS", "https://bsc-dataseed1.defibit.io/,https://bsc-dataseed1.ninicoin.io/"
+            ).split(",") if url and url != self.BSC_RPC
+        ]
+        self.web3s = []
+        for rpc in self.BSC_RPCS:
+            # web3 sets a fresh per-request timeout unless one is passed, so hand it the shared one
+            w3 = AsyncWeb3(OrjsonHTTPProvider(rpc, request_kwargs={"timeout": RPC_TIMEOUT}))
+            w3.middleware_onion.inject(async_geth_poa_middleware, layer=0)
+            self.web3s.append(w3)
+        self.web3 = self.web3s[0]
+        self.pair = None  # PancakeSwap USDT/BUSD pair, resolved by connect()
+        self.rpc_pool = list(self.web3s)  # Reachable endpoints, narrowed by connect()
+        self.rpc_latency = {w3: 0.0 for w3 in self.web3s}  # EMA of observed latency (s)
+        # Optional WebSocket endpoint; when set, scans run on every new block
+        self.BSC_WS = os.getenv("BSC_WS")
         self.private_key = os.getenv("PRIVATE_KEY")
         if not self.private_key:
             raise ValueError("PRIVATE_KEY environment variable not set.")
@@ -34,116 +113,694 @@ class FlashLoanArbBot:
         self.address = self.account.address
 
         self.router = self.web3.eth.contract(address=PANCAKE_ROUTER, abi=ROUTER_ABI)
+        # Load your deployed flash loan contract ABI and address from environment or file
+        contract_address = os.getenv("FLASHLOAN_CONTRACT_ADDRESS")
+        if not contract_address:
+            raise ValueError("FLASHLOAN_CONTRACT_ADDRESS environment variable not set.")
+        with open("FlashLoanArb.abi") as f:
+            contract_abi = f.read()
         self.flashloan_contract = self.web3.eth.contract(
-            address=FLASHLOAN_CONTRACT_ADDRESS,
-            abi=FLASHLOAN_CONTRACT_ABI
+            address=Web3.to_checksum_address(contract_address),
+            abi=contract_abi
         )
+        # ABI-encoded getAmountsOut path tails, keyed by path tuple
+        self._path_tails = {}
+        # BNB price, account BNB balance and block number in one Multicall3 eth_call, encoded once
+        self._state_call = self._multicall([
+            self._amounts_out_call(10**18, (WBNB, USDT)),
+            {"to": MULTICALL3, "data": GET_ETH_BALANCE_SELECTOR + self.web3.codec.encode(["address"], [self.address]).hex()},
+            {"to": MULTICALL3, "data": GET_BLOCK_NUMBER_SELECTOR},
+        ])
 
         # User settings
         self.min_loan = int(100 * 10**18)   # Try with 100 USDT (change as needed)
         self.max_loan = int(5000 * 10**18)  # Max 5000 USDT (change as needed)
         self.loan_step = int(100 * 10**18)  # Step size for loan search
-        self.flashloan_fee = 0.0009         # 0.09% for DODO
+        self.flashloan_fee_bps = 9          # 0.09% for DODO
         self.gas_limit = 600000             # Estimate for flash loan arb
         self.slippage = 0.002               # 0.2% slippage
+        self.max_leg2_premium_bps = 50      # Best leg-2 rate assumed possible on a stable pair (0.5%)
+        self.leg2_requote_bps = 5           # Re-price leg 2 if the leg-1 guess was off by >0.05%
+        self.poll_interval = 5              # Seconds between opportunity scans
+        self.min_check_gap = 1              # Debounce for back-to-back blocks
+        self.race_width = 2                 # Read calls race this many of the fastest RPCs
+        self.rpc_error_penalty = 5.0        # Latency sample charged for a failed RPC
+        self.rpc_reprobe = 60               # Seconds between health probes of every RPC
+        self.rpc_retries = 3                # Attempts per raw RPC batch when rate-limited (HTTP 429)
+        self.head_timeout = 6               # Re-check a receipt if no head arrives for two blocks
+        self.head_stall = 15                # Reconnect the block subscription after 15s without a head
+        self.ws_reconnects = 3              # Fall back to timed polling after 3 silent reconnects
+        self.nonce_resync = 300             # Re-read nonce from RPC every 5 minutes
+        self.gas_ttl = 30                   # Refresh gas and BNB prices when older than 30s
 
-    def get_amount_out(self, amount_in, path):
+        # Fixed executeArbitrage tx fields; each send only adds data, nonce and gasPrice
+        self._tx_template = {
+            'chainId': BSC_CHAIN_ID,
+            'from': self.address,
+            'to': self.flashloan_contract.address,
+            'value': 0,
+            'gas': self.gas_limit,
+        }
+
+        self.gas_price = None
+        self.bnb_usdt_wei = None
+        self.bnb_balance = None
+        self._gas_last_updated = 0
+        self._gas_refresh = None
+        self._bg_tasks = set()
+        self._leg1_ema = {}  # (direction, loan) -> EMA of the leg-1 output
+        self.block_number = None
+        self.last_check = None
+        self._new_block = asyncio.Event()
+        self._head_watcher = None
+        self._head_waiters = {}  # tx hash -> Event set on every new head
+        self._heads_seen = 0
+        self._trade = None  # In-flight execute_flashloan task
+        self._idle_scan_key = None  # (USDT reserve, BUSD reserve, gas cost) of the last empty scan
+        self._rpc_sem = asyncio.Semaphore(8)  # Caps concurrent raw RPC POSTs
+
+        self._nonce = None
+        self._nonce_synced = 0
+        self._nonce_lock = asyncio.Lock()
+        self._nonce_generation = 0  # Bumped whenever a nonce is handed out or its send settles
+        self._unconfirmed = 0  # Sent flash loan TXs still waiting for a receipt
+        self.session = None
+
+    async def _ensure_session(self):
+        # One keep-alive pool for the bot's whole lifetime, created on first use by any caller.
+        # It is never recreated: web3 would swap its own default session in for a closed one
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=RPC_TIMEOUT, connector=aiohttp.TCPConnector(
+                limit=64, limit_per_host=16, ttl_dns_cache=300, use_dns_cache=True,
+                keepalive_timeout=75, enable_cleanup_closed=True, force_close=False,
+            ))
+            for w3 in self.web3s:
+                if await w3.provider.cache_async_session(self.session) is not self.session:
+                    logger.warning("web3 already holds a session for %s; it will not use the bot's pool",
+                                   w3.provider.endpoint_uri)
+        elif self.session.closed:
+            raise RuntimeError("Bot session is closed")
+        return self.session
+
+    async def _probe(self, w3):
+        # Latency of one eth_chainId call; an endpoint on another chain counts as unreachable,
+        # since every tx is signed for BSC_CHAIN_ID
+        started = time.monotonic()
+        chain_id = await w3.eth.chain_id
+        if chain_id != BSC_CHAIN_ID:
+            raise ValueError(f"{w3.provider.endpoint_uri} is on chain {chain_id}, not {BSC_CHAIN_ID}")
+        return time.monotonic() - started
+
+    async def connect(self):
+        # Returns False, leaving the pool as it was, when no RPC answers
+        await self._ensure_session()
+        # Probe every RPC concurrently and seed the latency ranking with the results
+        latencies = await asyncio.gather(*(self._probe(w3) for w3 in self.web3s), return_exceptions=True)
+        reachable = [w3 for w3, latency in zip(self.web3s, latencies) if not isinstance(latency, Exception)]
+        if not reachable:
+            return False
+        self.rpc_pool = reachable
+        for w3, latency in zip(self.web3s, latencies):
+            if not isinstance(latency, Exception):
+                self.rpc_latency[w3] = latency
         try:
-            amounts = self.router.functions.getAmountsOut(amount_in, path).call()
-            return amounts[-1]
+            self.pair = await self._find_pair()
+        except Exception as e:
+            logger.warning("Error resolving USDT/BUSD pair, scanning every loan size: %s", e)
+        # Warm gas, prices, balance and the nonce before the first scan
+        await self._refresh_gas_parameters()
+        return True
+
+    async def _reprobe_rpcs(self):
+        # Re-probe every RPC periodically so dropped endpoints can rejoin and idle standbys stay ranked
+        while True:
+            await asyncio.sleep(self.rpc_reprobe)
+            latencies = await asyncio.gather(*(self._probe(w3) for w3 in self.web3s), return_exceptions=True)
+            for w3, latency in zip(self.web3s, latencies):
+                self._record_latency(w3, self.rpc_error_penalty if isinstance(latency, Exception) else latency)
+            reachable = [w3 for w3, latency in zip(self.web3s, latencies) if not isinstance(latency, Exception)]
+            if reachable:  # Keep the old pool rather than none at all
+                self.rpc_pool = reachable
+
+    async def _find_pair(self):
+        # Resolve the router's USDT/BUSD pair once so its reserves can be read directly
+        factory = await self._race(lambda w3: w3.eth.call({"to": PANCAKE_ROUTER, "data": FACTORY_SELECTOR}))
+        factory = self.web3.codec.decode(["address"], factory)[0]
+        call = {"to": factory, "data": GET_PAIR_SELECTOR + self.web3.codec.encode(["address", "address"], [USDT, BUSD]).hex()}
+        pair = await self._race(lambda w3: w3.eth.call(call))
+        return Web3.to_checksum_address(self.web3.codec.decode(["address"], pair)[0])
+
+    async def get_reserves(self):
+        # Current pair reserves keyed by token address
+        call = {"to": self.pair, "data": GET_RESERVES_SELECTOR}
+        raw = await self._race(lambda w3: w3.eth.call(call))
+        reserve0, reserve1, _ = self.web3.codec.decode(["uint112", "uint112", "uint32"], raw)
+        token0, token1 = sorted((USDT, BUSD), key=lambda token: int(token, 16))
+        return {token0: reserve0, token1: reserve1}
+
+    async def close(self):
+        if self._trade is not None and not self._trade.done():
+            await asyncio.wait({self._trade})  # Let a trade being sent finish before the session goes
+        # Then stop the head watcher, RPC re-probes, gas refreshes and receipt reports
+        tasks = [task for task in self._bg_tasks if task is not self._trade]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
+
+    def _spawn(self, coro):
+        # Run off the hot path; keep a reference so the task is not garbage collected.
+        # The set is not capped: callers keep it small (one gas refresh, head watcher and re-probe
+        # loop at a time, plus the in-flight trade and one receipt report per sent TX)
+        task = asyncio.create_task(coro)
+        self._bg_tasks.add(task)
+        task.add_done_callback(self._bg_tasks.discard)
+        return task
+
+    def _record_latency(self, w3, sample):
+        self.rpc_latency[w3] = (self.rpc_latency[w3] * 3 + sample) / 4
+
+    async def _race(self, make_call):
+        # Race a read-only call across the fastest RPCs; standbys are tried only if those fail
+        await self._ensure_session()
+        ranked = sorted(self.rpc_pool, key=self.rpc_latency.__getitem__)
+        primary, standby = ranked[:self.race_width], ranked[self.race_width:]
+        try:
+            return await self._race_group(primary, make_call)
+        except RPC_FAILOVER_ERRORS:
+            if not standby:
+                raise
+            return await self._race_group(standby, make_call)
+
+    async def _race_group(self, web3s, make_call):
+        # Fire the call at each RPC and keep the first successful answer
+        started = time.monotonic()
+        owners = {asyncio.ensure_future(make_call(w3)): w3 for w3 in web3s}
+        pending = set(owners)
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = None
+                # Look at every finished task, so failed siblings of a winner still have their errors retrieved
+                for task in done:
+                    exception = task.exception()
+                    if exception is None:
+                        winner = winner or task
+                        continue
+                    if isinstance(exception, RPC_FAILOVER_ERRORS):
+                        self._record_latency(owners[task], self.rpc_error_penalty)
+                    error = error or exception
+                if winner is not None:
+                    self._record_latency(owners[winner], time.monotonic() - started)
+                    return winner.result()
+            raise error
+        finally:
+            # Losers were at least as slow as the winner; charge them that much
+            elapsed = time.monotonic() - started
+            for task in pending:
+                task.cancel()
+                self._record_latency(owners[task], elapsed)
+
+    async def _broadcast(self, raw_tx):
+        # Push the same signed tx to every RPC and return on the first acceptance;
+        # the slower sends keep propagating in the background
+        await self._ensure_session()
+        pending = set()
+        for w3 in self.rpc_pool:
+            task = self._spawn(w3.eth.send_raw_transaction(raw_tx))
+            task.add_done_callback(lambda send: send.cancelled() or send.exception())  # Nobody awaits the losers
+            pending.add(task)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                exception = task.exception()
+                if exception is None:
+                    return task.result()
+                # A node's rejection ("nonce too low", "already known") says more than a timeout
+                if error is None or (isinstance(error, RPC_FAILOVER_ERRORS)
+                                     and not isinstance(exception, RPC_FAILOVER_ERRORS)):
+                    error = exception
+        raise error
+
+    def _amounts_out_call(self, amount_in, path):
+        # Raw getAmountsOut eth_call; only the amount word changes, the path tail is cached
+        tail = self._path_tails.get(path)
+        if tail is None:
+            tail = self.web3.codec.encode(["uint256", "address[]"], [0, list(path)])[32:].hex()
+            self._path_tails[path] = tail
+        return {"to": PANCAKE_ROUTER, "data": f"{GET_AMOUNTS_OUT_SELECTOR}{amount_in:064x}{tail}"}
+
+    def _multicall(self, calls):
+        # Wrap eth_call dicts into a single Multicall3 aggregate3 call
+        args = self.web3.codec.encode(
+            ["(address,bool,bytes)[]"],
+            [[(call["to"], True, bytes.fromhex(call["data"][2:])) for call in calls]],
+        )
+        return {"to": MULTICALL3, "data": AGGREGATE3_SELECTOR + args.hex()}
+
+    def _decode_multicall(self, raw):
+        # Return data of each aggregate3 sub-call, or None where it failed
+        results = self.web3.codec.decode(["(bool,bytes)[]"], bytes.fromhex(raw[2:]))[0]
+        return [data if success else None for success, data in results]
+
+    async def get_amount_out(self, amount_in, path):
+        try:
+            call = self._amounts_out_call(amount_in, path)
+            raw = await self._race(lambda w3: w3.eth.call(call))
+            return self.web3.codec.decode(["uint256[]"], raw)[0][-1]
         except Exception as e:
-            print(f"Error getting amount out: {e}")
+            logger.error("Error getting amount out: %s", e)
             return 0
 
-    def get_bnb_usdt_price(self):
-        # Get BNB price in USDT using PancakeSwap
+    async def _post_batch(self, url, payload):
+        # Rate-limited (429) replies are retried a few times with jittered backoff
+        session = await self._ensure_session()
+        body = orjson.dumps(payload)
+        for attempt in range(self.rpc_retries):
+            async with self._rpc_sem:
+                async with session.post(url, data=body, headers=JSON_HEADERS) as resp:
+                    if resp.status != 429 or attempt == self.rpc_retries - 1:
+                        resp.raise_for_status()
+                        replies = orjson.loads(await resp.read())
+                        if not isinstance(replies, list):
+                            error = replies.get("error") if isinstance(replies, dict) else replies
+                            raise BatchRejectedError(f"{url} rejected the batch: {error}")
+                        return replies
+            await asyncio.sleep(0.25 * (attempt + 1) * random.uniform(0.8, 1.2))
+
+    async def _rpc_batch(self, calls):
+        # Send several JSON-RPC calls in one HTTP POST; failed calls come back as None
+        payload = [{"jsonrpc": "2.0", "id": i, "method": method, "params": params}
+                   for i, (method, params) in enumerate(calls)]
+        replies = await self._race(lambda w3: self._post_batch(w3.provider.endpoint_uri, payload))
+        replies = {reply["id"]: reply for reply in replies}
+        results = []
+        for i, (method, _) in enumerate(calls):
+            reply = replies.get(i, {})
+            if "result" not in reply:
+                logger.error("RPC %s failed: %s", method, reply.get('error'))
+            results.append(reply.get("result"))
+        return results
+
+    def get_bnb_usdt_price(self, raw_amounts):
+        # Decode the BNB price in USDT from the PancakeSwap getAmountsOut probe
+        try:
+            amounts = self.web3.codec.decode(["uint256[]"], raw_amounts)[0]
+            return amounts[-1]
+        except Exception as e:
+            logger.error("Error getting BNB price: %s", e)
+            return 600 * 10**18  # fallback
+
+    async def update_gas_parameters(self):
+        # Gas price, the Multicall3 state read and the pending nonce travel in one JSON-RPC batch
+        generation = self._nonce_generation
+        gas_price, state, nonce = await self._rpc_batch([
+            ("eth_gasPrice", []),
+            ("eth_call", [self._state_call, "latest"]),
+            ("eth_getTransactionCount", [self.address, "pending"]),
+        ])
+        if gas_price is None:
+            raise ValueError("Could not fetch gas price")
+        self.gas_price = int(gas_price, 16)
+        price_data = balance_data = block_data = None
+        if state is not None:
+            price_data, balance_data, block_data = self._decode_multicall(state)
+        self.bnb_usdt_wei = self.get_bnb_usdt_price(price_data)
+        if balance_data is not None:
+            self.bnb_balance = int.from_bytes(balance_data, "big")
+        if block_data is not None:
+            self.block_number = int.from_bytes(block_data, "big")
+        nonce_stale = self._nonce is None or time.time() - self._nonce_synced > self.nonce_resync
+        if nonce is not None and nonce_stale and generation == self._nonce_generation and not self._unconfirmed:
+            # Prefetched and re-synced here so the trade path does not have to ask for it; skipped if a send
+            # overlapped this read or is still unconfirmed, since the RPC's pending count may lag it
+            self._nonce = int(nonce, 16)
+            self._nonce_synced = time.time()
+        self._gas_last_updated = time.time()
+
+    async def _refresh_gas_parameters(self):
         try:
-            wbnb = Web3.to_checksum_address("0xbb4CdB9CBd36B01bD1cBaEBF2De08d9173bc095c")
-            amounts = self.router.functions.getAmountsOut(10**18, [wbnb, USDT]).call()
-            return amounts[-1] / 1e18
+            await self.update_gas_parameters()
         except Exception as e:
-            print(f"Error getting BNB price: {e}")
-            return 600  # fallback
-
-    def estimate_gas_cost_usdt(self):
-        gas_price = self.web3.eth.gas_price
-        bnb_usdt = self.get_bnb_usdt_price()
-        return self.gas_limit * gas_price / 1e18 * bnb_usdt
-
-    def expected_profit(self, loan_amount, direction):
-        # direction: True = USDT->BUSD->USDT, False = BUSD->USDT->BUSD
-        if direction:
-            out1 = self.get_amount_out(loan_amount, [USDT, BUSD])
-            out2 = self.get_amount_out(out1, [BUSD, USDT])
+            logger.error("Error refreshing gas parameters: %s", e)
+
+    async def ensure_gas_parameters(self):
+        # Serve cached gas data and revalidate it in the background once stale
+        if self.gas_price is None:
+            await self.update_gas_parameters()
+        elif time.time() - self._gas_last_updated > self.gas_ttl and (
+                self._gas_refresh is None or self._gas_refresh.done()):
+            self._gas_refresh = self._spawn(self._refresh_gas_parameters())
+
+    def gas_cost_usdt(self):
+        # Gas cost in USDT wei, kept in integers like every other amount in the scan
+        return self.gas_limit * self.gas_price * self.bnb_usdt_wei // 10**18
+
+    def net_profit(self, loan_amount, amount_back, gas_cost):
+        # Round-trip result after repaying the loan, the flash-loan fee and gas
+        return amount_back - loan_amount - loan_amount * self.flashloan_fee_bps // 10_000 - gas_cost
+
+    def _leg2_ceiling(self, out1):
+        # Best leg-2 return we consider possible for a given leg-1 output
+        return out1 * (10_000 + self.max_leg2_premium_bps) // 10_000
+
+    async def expected_profit(self, loan_amount, direction, gas_cost):
+        token_in, token_out, label = DIRECTIONS[direction]
+        key = (direction, loan_amount)
+        guess = self._leg1_ema.get(key)
+        out2 = None
+        if guess is not None and self.net_profit(loan_amount, self._leg2_ceiling(guess), gas_cost) >= 0:
+            # Price leg 2 on the expected leg-1 output concurrently with leg 1
+            out1, out2 = await asyncio.gather(
+                self.get_amount_out(loan_amount, (token_in, token_out)),
+                self.get_amount_out(guess, (token_out, token_in)),
+            )
+            if abs(out1 - guess) * 10_000 > out1 * self.leg2_requote_bps:
+                out2 = None  # Guess was off, re-price leg 2 below
         else:
-            out1 = self.get_amount_out(loan_amount, [BUSD, USDT])
-            out2 = self.get_amount_out(out1, [USDT, BUSD])
-        flash_fee = loan_amount * self.flashloan_fee
-        gas_cost = self.estimate_gas_cost_usdt()
-        profit = out2 - loan_amount - flash_fee - gas_cost
-        print(f"Loan: {loan_amount/1e18:.2f}, Dir: {'USDT→BUSD→USDT' if direction else 'BUSD→USDT→BUSD'}, "
-              f"Profit: {profit/1e18:.6f} USDT, Gas: {gas_cost:.4f} USDT, Fee: {flash_fee/1e18:.6f} USDT")
+            out1 = await self.get_amount_out(loan_amount, (token_in, token_out))
+        if out1:
+            self._leg1_ema[key] = out1 if guess is None else (guess * 7 + out1) // 8
+        # Skip the leg-2 RPC when even a generous return rate cannot break even
+        bound = self.net_profit(loan_amount, self._leg2_ceiling(out1), gas_cost)
+        if bound < 0:
+            return bound
+        if out2 is None:
+            out2 = await self.get_amount_out(out1, (token_out, token_in))
+        profit = self.net_profit(loan_amount, out2, gas_cost)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(PROBE_MSG.format_map({
+                "loan": loan_amount / 1e18, "label": label, "profit": profit / 1e18,
+                "gas": gas_cost / 1e18, "fee": loan_amount * self.flashloan_fee_bps / 10_000 / 1e18,
+            }))
         return profit
 
-    def find_best_opportunity(self):
-        best_profit = 0
-        best_amount = 0
-        best_direction = True
-        for direction in [True, False]:
-            for loan in range(self.min_loan, self.max_loan + self.loan_step, self.loan_step):
-                profit = self.expected_profit(loan, direction)
-                if profit > best_profit:
-                    best_profit = profit
-                    best_amount = loan
-                    best_direction = direction
-        return best_profit, best_amount, best_direction
-
-    def execute_flashloan(self, loan_amount, direction):
-        print(f"Executing flash loan: {loan_amount/1e18:.2f} USDT, Direction: {'USDT→BUSD→USDT' if direction else 'BUSD→USDT→BUSD'}")
-        nonce = self.web3.eth.get_transaction_count(self.address)
-        tx = self.flashloan_contract.functions.executeArbitrage(
-            loan_amount, direction
-        ).build_transaction({
-            'from': self.address,
-            'nonce': nonce,
-            'gas': self.gas_limit,
-            'gasPrice': self.web3.eth.gas_price,
-        })
-        signed = self.web3.eth.account.sign_transaction(tx, self.private_key)
-        tx_hash = self.web3.eth.send_raw_transaction(signed.rawTransaction)
-        print(f"Flash loan TX: {self.web3.to_hex(tx_hash)}")
-        receipt = self.web3.eth.wait_for_transaction_receipt(tx_hash)
-        print("Transaction receipt:", receipt)
-        return receipt.status == 1
-
-    def run(self):
-        print("Flash Loan Arbitrage Bot started.")
+    def _loan_sizes(self):
+        return range(self.min_loan, self.max_loan + self.loan_step, self.loan_step)
+
+    def _local_profit(self, loan, reserve_in, reserve_out, gas_cost):
+        # Mirror the two router probes locally on the pair reserves
+        out1 = v2_amount_out(loan, reserve_in, reserve_out)
+        return self.net_profit(loan, v2_amount_out(out1, reserve_out, reserve_in), gas_cost)
+
+    def _best_loan(self, reserves, direction, gas_cost):
+        # Closed-form optimum on the reserves, snapped to the loan grid; None if no size can profit.
+        # Profit is concave in the loan, so the best in-range size sits next to the clamped optimum
+        token_in, token_out, _ = DIRECTIONS[direction]
+        reserve_in, reserve_out = reserves[token_in], reserves[token_out]
+        if not reserve_in or not reserve_out:
+            return None  # Drained or uninitialised pair
+        optimum = v2_optimal_input(reserve_in, reserve_out, reserve_out, reserve_in, self.flashloan_fee_bps)
+        optimum = min(max(optimum, self.min_loan), self.max_loan)
+        below = self.min_loan + (optimum - self.min_loan) // self.loan_step * self.loan_step
+        above = min(below + self.loan_step, self.max_loan)
+        loan = max(below, above, key=lambda size: self._local_profit(size, reserve_in, reserve_out, gas_cost))
+        if self._local_profit(loan, reserve_in, reserve_out, gas_cost) <= 0:
+            return None
+        return loan
+
+    async def _amounts_out_batch(self, probes):
+        # Price (amount_in, path) probes in one Multicall3 eth_call; 0 where a probe failed
+        (raw,) = await self._rpc_batch([
+            ("eth_call", [self._multicall([self._amounts_out_call(a, p) for a, p in probes]), "latest"]),
+        ])
+        if raw is None:
+            return [0] * len(probes)
+        return [self.web3.codec.decode(["uint256[]"], data)[0][-1] if data else 0
+                for data in self._decode_multicall(raw)]
+
+    async def _batched_scan(self, gas_cost):
+        # Every loan size in both directions, as one batch of leg-1 probes and one of leg-2 probes
+        probes = [(direction, loan) for direction in DIRECTIONS for loan in self._loan_sizes()]
+        out1s = await self._amounts_out_batch(
+            [(loan, DIRECTIONS[direction][:2]) for direction, loan in probes])
+        # Skip leg 2 where even a generous return rate cannot break even
+        viable = [(direction, loan, out1) for (direction, loan), out1 in zip(probes, out1s)
+                  if out1 and self.net_profit(loan, self._leg2_ceiling(out1), gas_cost) > 0]
+        if not viable:
+            return 0, 0, True
+        out2s = await self._amounts_out_batch(
+            [(out1, DIRECTIONS[direction][1::-1]) for direction, _, out1 in viable])
+        results = [(self.net_profit(loan, out2, gas_cost), loan, direction)
+                   for (direction, loan, _), out2 in zip(viable, out2s) if out2]
+        return max((result for result in results if result[0] > 0),
+                   key=lambda result: result[0], default=(0, 0, True))
+
+    async def _sized_scan(self, reserves, gas_cost):
+        # One router probe per direction, at the loan sized from the reserves
+        loans = {}
+        for direction in DIRECTIONS:
+            loan = self._best_loan(reserves, direction, gas_cost)
+            if loan is not None:
+                loans[direction] = loan
+        profits = await asyncio.gather(*(self.expected_profit(loan, d, gas_cost) for d, loan in loans.items()))
+        results = [(profit, loan, d) for profit, (d, loan) in zip(profits, loans.items()) if profit > 0]
+        return max(results, key=lambda result: result[0], default=(0, 0, True))
+
+    async def find_best_opportunity(self):
+        # Gas cost is the same for every probe, fetch it once per scan
+        await self.ensure_gas_parameters()
+        gas_cost = self.gas_cost_usdt()
+        # With the pair reserves, one getReserves call sizes the loan instead of probing every step
+        if self.pair is not None:
+            try:
+                reserves = await self.get_reserves()
+            except Exception as e:
+                logger.error("Error reading pair reserves, scanning every loan size: %s", e)
+            else:
+                # Unchanged reserves and gas cost would only repeat the last empty scan's probes
+                key = (reserves[USDT], reserves[BUSD], gas_cost)
+                if key == self._idle_scan_key:
+                    return 0, 0, True
+                result = await self._sized_scan(reserves, gas_cost)
+                self._idle_scan_key = key if result[0] <= 0 else None
+                return result
+        return await self._batched_scan(gas_cost)
+
+    async def next_nonce(self):
+        # Nonce is tracked locally; the periodic re-sync belongs to update_gas_parameters, so the
+        # RPC is only asked here before the warm-up landed or after a nonce error cleared it
+        async with self._nonce_lock:
+            if self._nonce is None:
+                self._nonce = await self._race(lambda w3: w3.eth.get_transaction_count(self.address, 'pending'))
+                self._nonce_synced = time.time()
+            nonce = self._nonce
+            self._nonce += 1
+            self._nonce_generation += 1
+            return nonce
+
+    async def execute_flashloan(self, loan_amount, direction):
+        logger.info(EXECUTE_MSG.format_map({"loan": loan_amount / 1e18, "label": DIRECTIONS[direction][2]}))
+        arbitrage = self.flashloan_contract.functions.executeArbitrage(loan_amount, direction)
+        # Scanning uses cheap getAmountsOut probes; only the winning trade is simulated in full
+        try:
+            await arbitrage.call({'from': self.address})
+        except Exception as e:
+            logger.warning("Flash loan simulation reverted, skipping: %s", e)
+            return None
+        gas_price = await self._race(lambda w3: w3.eth.gas_price)
+        if self.bnb_balance is not None and self.bnb_balance < self.gas_limit * gas_price:
+            logger.warning("Not enough BNB for gas (%.5f BNB), skipping", self.bnb_balance / 1e18)
+            return None
+        data = self.flashloan_contract.encodeABI(fn_name="executeArbitrage", args=[loan_amount, direction])
+        for attempt in range(2):
+            try:
+                tx = {**self._tx_template, 'data': data, 'nonce': await self.next_nonce(), 'gasPrice': gas_price}
+                # With the coincurve backend signing takes tens of microseconds, less than a thread hop
+                signed = self.account.sign_transaction(tx)
+                tx_hash = await self._broadcast(signed.rawTransaction)
+                break
+            except Exception as e:
+                error = str(e).lower()
+                if "already known" in error:
+                    tx_hash = signed.hash  # A node already has this exact tx
+                    break
+                self._nonce = None  # Force a re-sync on the next attempt
+                if attempt or "nonce too low" not in error:
+                    raise
+                logger.warning("Local nonce was stale (%s), retrying with a fresh one", e)
+            finally:
+                self._nonce_generation += 1
+        self._unconfirmed += 1
+        logger.info("Flash loan TX: %s", self.web3.to_hex(tx_hash))
+        if self.bnb_balance is not None:
+            self.bnb_balance -= self.gas_limit * gas_price  # Worst-case spend until the receipt lands
+        self._spawn(self._report_receipt(tx_hash))
+        return tx_hash
+
+    async def _report_receipt(self, tx_hash):
+        try:
+            receipt = await self._wait_for_confirmation(tx_hash)
+        except Exception as e:
+            logger.error("Error waiting for flash loan TX: %s", e)
+            return
+        finally:
+            self._unconfirmed -= 1
+            self._gas_last_updated = 0  # Re-read the BNB balance on the next scan
+        if receipt is None:
+            logger.warning("Flash loan TX not mined before timeout")
+        else:
+            logger.info("Transaction receipt: %s", receipt)
+
+    async def _wait_for_confirmation(self, tx_hash, timeout=120):
+        # With a live head subscription the receipt is checked once per new block;
+        # otherwise poll on a backoff schedule that starts near the ~3s BSC block time
+        deadline = time.monotonic() + timeout
+        polls = 0
+        new_head = self._head_waiters[tx_hash] = asyncio.Event()
+        try:
+            while time.monotonic() < deadline:
+                try:
+                    return await self._race(lambda w3: w3.eth.get_transaction_receipt(tx_hash))
+                except TransactionNotFound:
+                    pass
+                wait = self.head_timeout if self._heads_live() else RECEIPT_POLL_DELAYS[polls]
+                try:
+                    await asyncio.wait_for(new_head.wait(), min(wait, max(0, deadline - time.monotonic())))
+                except asyncio.TimeoutError:
+                    pass
+                new_head.clear()
+                polls = min(polls + 1, len(RECEIPT_POLL_DELAYS) - 1)
+            return None
+        finally:
+            del self._head_waiters[tx_hash]
+
+    async def run(self):
+        try:
+            delay = 1
+            while not await self.connect():
+                logger.error("Cannot connect to any BSC RPC (%s), retrying in %ss", ", ".join(self.BSC_RPCS), delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+            logger.info("Flash Loan Arbitrage Bot started.")
+            self._spawn(self._reprobe_rpcs())
+            if self.BSC_WS:
+                self._head_watcher = self._spawn(self._watch_heads())
+                await self._block_loop()
+                logger.warning("Block subscription ended, falling back to timed polling.")
+            await self._loop()
+        finally:
+            await self.close()
+
+    async def _watch_heads(self):
+        # Keeps the newHeads subscription open, reconnecting when it drops or goes quiet;
+        # gives up after ws_reconnects attempts in a row that deliver no heads
+        attempts = 0
+        try:
+            while attempts < self.ws_reconnects:
+                attempts += 1
+                seen = self._heads_seen
+                try:
+                    await self._follow_heads()
+                except Exception as e:
+                    logger.error("Error in block subscription: %s", e)
+                if self._heads_seen > seen:
+                    attempts = 0
+        finally:
+            self._new_block.set()  # Let the block loop notice the subscription ended
+
+    async def _follow_heads(self):
+        # Follow the chain head over eth_subscribe("newHeads"); wakes the block loop and receipt waiters
+        session = await self._ensure_session()
+        async with session.ws_connect(self.BSC_WS, heartbeat=30) as ws:
+            await ws.send_str(orjson.dumps({
+                "jsonrpc": "2.0", "id": 1, "method": "eth_subscribe", "params": ["newHeads"],
+            }).decode())
+            while True:
+                try:
+                    msg = await ws.receive(timeout=self.head_stall)
+                except asyncio.TimeoutError:
+                    logger.warning("No block for %ss, reconnecting the block subscription", self.head_stall)
+                    return
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    return
+                head = orjson.loads(msg.data).get("params", {}).get("result")
+                if head:
+                    self._heads_seen += 1
+                    self.block_number = int(head["number"], 16)
+                    self._new_block.set()
+                    for new_head in self._head_waiters.values():
+                        new_head.set()
+
+    def _heads_live(self):
+        return self._head_watcher is not None and not self._head_watcher.done()
+
+    async def _check_and_execute(self):
+        # Returns True when a flash loan was sent
+        self.last_check = time.time()
+        profit, amount, direction = await self.find_best_opportunity()
+        if profit > 0:
+            profit_bps = profit * 10_000 // amount
+            logger.info(FOUND_MSG.format_map({"profit": profit / 1e18, "percent": profit_bps / 100, "loan": amount / 1e18}))
+            # Shielded so cancelling the bot mid-send cannot leave a nonce half-used
+            self._trade = self._spawn(self.execute_flashloan(amount, direction))
+            return await asyncio.shield(self._trade) is not None
+        logger.info("No profitable opportunity. Waiting...")
+        return False
+
+    async def _block_loop(self):
+        # One scan per new block; heads that arrive mid-scan are coalesced
+        last_check = 0
+        resume_at = 0
         while True:
+            await self._new_block.wait()
+            self._new_block.clear()
+            if not self._heads_live():
+                return
+            now = time.monotonic()
+            if now < resume_at or now - last_check < self.min_check_gap:
+                continue
+            last_check = now
             try:
-                profit, amount, direction = self.find_best_opportunity()
-                if profit > 0:
-                    print(f"Profitable opportunity found! Profit: {profit/1e18:.6f} USDT (loan: {amount/1e18:.2f})")
-                    self.execute_flashloan(amount, direction)
-                    time.sleep(60)  # Wait after a trade
-                else:
-                    print("No profitable opportunity. Waiting...")
-                    time.sleep(5)
+                if await self._check_and_execute():
+                    resume_at = time.monotonic() + 60  # Wait after a trade
             except Exception as e:
-                print(f"Error in main loop: {e}")
-                time.sleep(10)
+                logger.error("Error in main loop: %s", e)
+                resume_at = time.monotonic() + 10
 
-# Flask app for Render port binding
-app = Flask(__name__)
+    async def _loop(self):
+        # Ticks are scheduled on the monotonic clock so scan time does not stretch the interval
+        next_tick = time.monotonic()
+        while True:
+            try:
+                if await self._check_and_execute():
+                    next_tick = time.monotonic() + 60  # Wait after a trade
+                else:
+                    next_tick += self.poll_interval
+            except Exception as e:
+                logger.error("Error in main loop: %s", e)
+                next_tick = time.monotonic() + 10
+            delay = next_tick - time.monotonic()
+            if delay < 0:
+                next_tick = time.monotonic()  # Overran the interval; don't try to catch up
+            await asyncio.sleep(max(0, delay))
 
-@app.route('/')
-def index():
-    return "Flash loan arbitrage bot is running."
+def setup_logging(level=logging.INFO):
+    # Log records are queued and written to stdout by a listener thread, so the loop never blocks on I/O
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)  # Flush records still queued at exit
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(QueueHandler(log_queue))
+    return listener
 
-def start_bot():
-    bot = FlashLoanArbBot()
-    bot.run()
+def use_uvloop():
+    # libuv-backed event loop where available; the stock asyncio loop otherwise (e.g. Windows)
+    try:
+        import uvloop
+    except ImportError:
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 if __name__ == "__main__":
-    Thread(target=start_bot, daemon=True).start()
-    port = int(os.environ.get("PORT", 10000))
-    app.run(host="0.0.0.0", port=port)
+    # Runs the bot alone; app.py serves it behind an HTTP port on the same event loop
+    setup_logging()
+    use_uvloop()
+    asyncio.run(FlashLoanArbBot().run())